@@ -1,17 +1,30 @@
 #!/usr/bin/env python
 from surlex import Surlex
+from surlex.profiler import profile_surlex
 import sys
 from optparse import OptionParser
 
 def main():
     parser = OptionParser()
-    parser.set_usage('surlex2regex.py <surlex>')
+    parser.set_usage('surlex2regex.py [options] <surlex>')
+    parser.add_option('-p', '--profile', dest='corpus', metavar='FILE',
+        help='profile matching against the subjects in FILE, one per line')
+    parser.add_option('-n', '--number', dest='number', type='int',
+        default=100, help='times to match the corpus per run (default 100)')
     if len(sys.argv) == 1:
         argv = ['-h']
     else:
         argv = sys.argv[1:]
     options, args = parser.parse_args(argv)
-    print (Surlex(args[0]).translate())
+    if options.corpus:
+        f = open(options.corpus)
+        try:
+            corpus = [line.rstrip('\r\n') for line in f]
+        finally:
+            f.close()
+        print (profile_surlex(args[0], corpus, number=options.number).report())
+    else:
+        print (Surlex(args[0]).translate())
 
 if __name__ == '__main__':
     main()
@@ -1,12 +1,105 @@
-from surlex.grammar import Parser, RegexScribe, get_all_nodes, MacroTagNode
+from surlex.grammar import Parser, RegexScribe, get_all_nodes, MacroTagNode, \
+    TextNode, canonicalize, literal_prefix, check_encoding
+from surlex.exceptions import MalformedSurlex
 from surlex.macros import MacroRegistry, DefaultMacroRegistry
 import re
 
+try:
+    from urllib.parse import parse_qsl
+except ImportError:
+    from urlparse import parse_qsl
+
+# compiled regexes shared by every surlex that canonicalizes to the same
+# regex; like re's own cache it is capped, dropping the oldest entry
+compiled_regexes = {}
+
+def compile_regex(regex, cache=None, max_size=None):
+    """
+        compile regex through cache, the shared compiled_regexes by
+        default. The cache is unbounded unless max_size is given, in which
+        case the oldest entry is dropped to make room for a new one.
+    """
+    if cache is None:
+        cache = compiled_regexes
+    try:
+        return cache[regex]
+    except KeyError:
+        if max_size is not None and len(cache) >= max_size:
+            try:
+                cache.pop(next(iter(cache)), None)
+            except StopIteration:
+                # another thread emptied the cache
+                pass
+        compiled = cache[regex] = re.compile(regex)
+        return compiled
+
+def buffer_groupdict(m, subject):
+    """
+        like groupdict(), but each capture is a memoryview slice of
+        the subject, so no bytes are copied or decoded
+    """
+    view = memoryview(subject)
+    groups = {}
+    for name in m.re.groupindex:
+        start, end = m.span(name)
+        if start == -1:
+            groups[name] = None
+        else:
+            groups[name] = view[start:end]
+    return groups
+
+class SurlexMatch(object):
+    """
+        a lazy match result: captures are only sliced out of the subject
+        when they are accessed
+    """
+    def __init__(self, m, subject, encoding=None):
+        self.m = m
+        self.subject = subject
+        self.encoding = encoding
+
+    def keys(self):
+        return self.m.re.groupindex.keys()
+
+    def __contains__(self, name):
+        return name in self.m.re.groupindex
+
+    def __getitem__(self, name):
+        if name not in self.m.re.groupindex:
+            raise KeyError(name)
+        start, end = self.m.span(name)
+        if start == -1:
+            return None
+        if self.encoding:
+            return memoryview(self.subject)[start:end]
+        return self.subject[start:end]
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def span(self, name):
+        if name not in self.m.re.groupindex:
+            raise KeyError(name)
+        return self.m.span(name)
+
+    def spans(self):
+        return dict((name, self.m.span(name)) for name in self.keys())
+
+    def __repr__(self):
+        return '<SurlexMatch %s>' % self.spans()
+
 class Surlex(object):
-    def __init__(self, surlex, macro_registry=DefaultMacroRegistry()):
+    def __init__(self, surlex, macro_registry=DefaultMacroRegistry(),
+                 encoding=None):
         self.translated = False
         self.surlex = surlex
         self.macro_registry = macro_registry
+        # with an encoding, the regex is a bytes pattern and match() works
+        # on bytes, bytearray and memoryview subjects
+        check_encoding(encoding)
+        self.encoding = encoding
 
     def translate(self):
         self.parser = Parser(self.surlex)
@@ -14,8 +107,21 @@ class Surlex(object):
         self.scribe = RegexScribe(
             self.node_list,
             self.macro_registry,
+            self.encoding,
         )
         self.regex = self.scribe.translate()
+        self.canonical_node_list = canonicalize(
+            self.node_list,
+            self.macro_registry,
+        )
+        self.canonical = RegexScribe(
+            self.canonical_node_list,
+            self.macro_registry,
+            self.encoding,
+        ).translate()
+        # compiled on first match, so translating never needs a valid regex
+        self.compiled = None
+        self.translated = True
         return self.regex
 
     @property
@@ -34,11 +140,154 @@ class Surlex(object):
             self.translate()
         return self.regex
 
+    def compile(self):
+        if not self.translated:
+            self.translate()
+        if self.compiled is None:
+            self.compiled = compile_regex(self.canonical)
+        return self.compiled
+
+    def regex_match(self, subject):
+        return self.compile().match(subject)
+
     def match(self, subject):
-        m = re.match(self.to_regex, subject)
+        m = self.regex_match(subject)
         if m:
+            if self.encoding:
+                return buffer_groupdict(m, subject)
             return m.groupdict()
 
+    def matches(self, subject):
+        """
+            True if the subject matches, without building any captures
+        """
+        return self.regex_match(subject) is not None
+
+    def match_spans(self, subject):
+        """
+            like match(), but captures are (start, end) offsets into the
+            subject, (-1, -1) for groups that did not participate
+        """
+        m = self.regex_match(subject)
+        if m:
+            return dict((name, m.span(name)) for name in m.re.groupindex)
+
+    def match_lazy(self, subject):
+        """
+            like match(), but returns a SurlexMatch that slices captures
+            out of the subject on access
+        """
+        m = self.regex_match(subject)
+        if m:
+            return SurlexMatch(m, subject, self.encoding)
+
+
+def query_params(query):
+    """
+        the first value of each parameter of a query string, or of a
+        mapping of parameters to values or lists of values
+    """
+    if query is None:
+        return {}
+    if isinstance(query, dict):
+        items = query.items()
+    else:
+        items = parse_qsl(query, keep_blank_values=True)
+    params = {}
+    for name, value in items:
+        if isinstance(value, (list, tuple)):
+            if not value:
+                continue
+            value = value[0]
+        params.setdefault(name, value)
+    return params
+
+class MultiSurlex(object):
+    """
+        matches structured subjects such as {'host': ..., 'path': ...,
+        'query': ...} with one surlex per field. The surlex for 'query' is
+        a mapping of parameter names to surlexes. Fields are checked
+        cheapest first, literal fields by a plain string comparison, and
+        the captures of every field are merged into one dict.
+
+        Each field keeps a regex of its own rather than being joined into
+        one regex over a separator-joined subject: a tag such as <name=.+>
+        or <name/> could then match across the separator into the next
+        field, and the join would build a new string for every request.
+    """
+    def __init__(self, fields, macro_registry=DefaultMacroRegistry()):
+        if not isinstance(fields, dict):
+            raise MalformedSurlex(
+                'Malformed surlex. Fields must be a mapping.')
+        for field, surlex in fields.items():
+            if field == 'query' and not isinstance(surlex, dict):
+                raise MalformedSurlex('Malformed surlex. Query must be a '
+                                      'mapping of parameters to surlexes.')
+            if field != 'query' and isinstance(surlex, dict):
+                raise MalformedSurlex(
+                    'Malformed surlex. Field %s must be a surlex.' % field)
+        self.translated = False
+        self.fields = fields
+        self.macro_registry = macro_registry
+
+    def translate(self):
+        checks = []
+        for field, surlex in self.fields.items():
+            if field == 'query':
+                for param, param_surlex in surlex.items():
+                    checks.append(self.translate_field(field, param, param_surlex))
+            else:
+                checks.append(self.translate_field(field, None, surlex))
+        names = set()
+        for cost, field, param, literal, surlex in checks:
+            for name in surlex.compile().groupindex:
+                if name in names:
+                    raise MalformedSurlex(
+                        'Malformed surlex. Duplicate capture %s.' % name)
+                names.add(name)
+        checks.sort(key=lambda check: check[0])
+        self.checks = [check[1:] for check in checks]
+        self.translated = True
+
+    def translate_field(self, field, param, surlex):
+        surlex = Surlex(surlex, self.macro_registry)
+        surlex.translate()
+        node_list = surlex.canonical_node_list
+        literal = None
+        if (len(node_list) == 1 and isinstance(node_list[0], TextNode) and
+                literal_prefix(node_list) == node_list[0].token):
+            literal = node_list[0].token
+        # query parameters last since the query string may need parsing,
+        # then literals before regexes, fewest tags and shortest regex
+        variable = len([node for node in get_all_nodes(node_list)
+                        if not isinstance(node, TextNode)])
+        cost = (param is not None, literal is None, variable,
+                len(surlex.canonical))
+        return cost, field, param, literal, surlex
+
+    def match(self, subject):
+        if not self.translated:
+            self.translate()
+        groups = {}
+        params = None
+        for field, param, literal, surlex in self.checks:
+            value = subject.get(field)
+            if param is not None:
+                if params is None:
+                    params = query_params(value)
+                value = params.get(param)
+            if value is None:
+                return None
+            if literal is not None:
+                if not value.startswith(literal):
+                    return None
+            else:
+                m = surlex.regex_match(value)
+                if not m:
+                    return None
+                groups.update(m.groupdict())
+        return groups
+
 # This allows "surlex.register_macro" to register to the default registry
 register_macro = DefaultMacroRegistry.register
 
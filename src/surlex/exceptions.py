@@ -17,3 +17,17 @@ class MacroDoesNotExist(SurlexException):
         this will be thrown
     """
     pass
+
+class MalformedRouteTable(SurlexException):
+    """
+        route table error -- when a buffer is not a route table
+        written by dump_route_table, or a route table cannot be written
+    """
+    pass
+
+class BadEncoding(SurlexException):
+    """
+        bytes mode error -- when an encoding does not map ASCII to
+        itself, so a bytes pattern could never match as intended
+    """
+    pass
@@ -1,7 +1,12 @@
 import re
-from surlex.exceptions import MalformedSurlex
+from surlex.exceptions import MalformedSurlex, BadEncoding
 from surlex.macros import MacroRegistry, DefaultMacroRegistry
 
+try:
+    from _sre import MAXREPEAT
+except ImportError:
+    from sre_constants import MAXREPEAT
+
 # Define the next function for python 2 and 3 compatibility
 try:
     if next:
@@ -33,6 +38,15 @@ class WildcardNode(Node):
     def __repr__(self):
         return '<WildcardNode>'
 
+class SegmentWildcardNode(Node):
+    def __init__(self):
+        pass
+    def __eq__(self, other):
+        return self.__class__ == other.__class__
+
+    def __repr__(self):
+        return '<SegmentWildcardNode>'
+
 class BlockNode(Node):
     def __init__(self, node_list):
         self.node_list = node_list
@@ -82,6 +96,21 @@ class MacroTagNode(TagNode):
     def __repr__(self):
         return '<MacroTagNode %s: %s>' % (self.name, self.macro)
 
+class SegmentTagNode(TagNode):
+    def __init__(self, name, min=1, max=1):
+        self.name = name
+        self.min = min
+        self.max = max
+
+    def __eq__(self, other):
+        return (self.__class__ == other.__class__ and
+                self.name == other.name and
+                self.min == other.min and
+                self.max == other.max)
+
+    def __repr__(self):
+        return '<SegmentTagNode %s: {%s,%s}>' % (self.name, self.min, self.max)
+
 class Parser(object):
     def __init__(self, surlex):
         self.surlex = surlex
@@ -91,21 +120,47 @@ class Parser(object):
         return list(self.parse(self.chars))
 
     def read_until(self, chars, char):
-        try:
-            next_char = next(chars)
-        except StopIteration:
-            raise MalformedSurlex('Malformed surlex. Expected %s.' % char)
-        if next_char == char:
-            return ''
-        if next_char == '\\':
-            # only escape what we are looking for
-            escaped_char = next(chars)
-            if escaped_char == char:
-                return escaped_char + self.read_until(chars, char)
+        output = []
+        for next_char in chars:
+            if next_char == char:
+                return ''.join(output)
+            if next_char == '\\':
+                # only escape what we are looking for
+                try:
+                    escaped_char = next(chars)
+                except StopIteration:
+                    break
+                if escaped_char != char:
+                    output.append('\\')
+                output.append(escaped_char)
             else:
-                return '\\' + escaped_char + self.read_until(chars, char)
+                output.append(next_char)
+        raise MalformedSurlex('Malformed surlex. Expected %s.' % char)
+
+    def parse_repeat(self, repeat):
+        """
+            parse the segment count of a segment tag: '', '{n}', '{min,}'
+            or '{min,max}'
+        """
+        if not repeat:
+            return 1, 1
+        m = re.match(r'^\{(\d+)(,(\d*))?\}$', repeat)
+        if not m:
+            raise MalformedSurlex('Malformed surlex. Bad repeat %s.' % repeat)
+        min = int(m.group(1))
+        if m.group(2) is None:
+            max = min
+        elif m.group(3):
+            max = int(m.group(3))
         else:
-            return next_char + self.read_until(chars, char)
+            max = None
+        if min < 1 or (max is not None and max < min):
+            raise MalformedSurlex('Malformed surlex. Bad repeat %s.' % repeat)
+        # the regex repeats the segments after the first, min - 1 times
+        if min > MAXREPEAT or (max is not None and max > MAXREPEAT):
+            raise MalformedSurlex('Malformed surlex. Repeat %s is too large.'
+                                  % repeat)
+        return min, max
 
     def parse(self, chars):
         token = ''
@@ -122,6 +177,7 @@ class Parser(object):
                 name = ''
                 regex = None
                 macro = None
+                segments = None
                 for char in tag_content:
                     if char == '=':
                         name, regex = tag_content.split('=', 1)
@@ -129,10 +185,17 @@ class Parser(object):
                     if char == ':':
                         name, macro = tag_content.split(':', 1)
                         break
-                if regex:
+                    if char == '/':
+                        name, segments = tag_content.split('/', 1)
+                        break
+                if tag_content == '*':
+                    yield SegmentWildcardNode()
+                elif regex:
                     yield RegexTagNode(name, regex)
                 elif macro:
                     yield MacroTagNode(name, macro)
+                elif segments is not None:
+                    yield SegmentTagNode(name, *self.parse_repeat(segments))
                 else:
                     yield TagNode(tag_content)
             elif char == '*':
@@ -149,10 +212,31 @@ class Parser(object):
         if token:
             yield TextNode(token)
 
+ASCII = ''.join(chr(i) for i in range(128))
+
+def check_encoding(encoding):
+    """
+        raise BadEncoding unless encoding maps ASCII to itself, as the
+        regex syntax and the URLs it matches are written in ASCII
+    """
+    if not encoding:
+        return
+    try:
+        ascii_compatible = ASCII.encode(encoding) == ASCII.encode('ascii')
+    except (LookupError, UnicodeError):
+        ascii_compatible = False
+    if not ascii_compatible:
+        raise BadEncoding(
+            'Encoding %s is not ASCII compatible.' % encoding)
+
 class RegexScribe(object):
-    def __init__(self, node_list, macro_registry=DefaultMacroRegistry()):
+    def __init__(self, node_list, macro_registry=DefaultMacroRegistry(),
+                 encoding=None):
         self.node_list = node_list
         self.macro_registry = macro_registry
+        # when an encoding is given, translate() emits a bytes pattern
+        check_encoding(encoding)
+        self.encoding = encoding
 
     def translate(self):
         output = ''
@@ -161,21 +245,144 @@ class RegexScribe(object):
                 output += node.token.replace('.', '\.')
             elif isinstance(node, WildcardNode):
                 output += '.*'
+            elif isinstance(node, SegmentWildcardNode):
+                output += '[^/]*'
             elif isinstance(node, OptionalNode):
-                output += '(' + RegexScribe(node.node_list).translate() + ')?'
+                output += '(' + RegexScribe(
+                    node.node_list,
+                    self.macro_registry,
+                ).translate() + ')?'
             elif isinstance(node, TagNode):
-                if isinstance(node, MacroTagNode):
-                    regex = self.macro_registry.get(node.macro)
-                elif isinstance(node, RegexTagNode):
-                    regex = node.regex
-                else:
-                    regex = '.+'
+                regex = self.tag_regex(node)
                 if node.name:
                     output += '(?P<%s>%s)' % (node.name, regex)
                 else:
                     output += regex
+        if self.encoding:
+            # macros and user regexes are encoded along with the text, so
+            # classes such as \d and \w take their ASCII-only bytes meaning
+            output = output.encode(self.encoding)
         return output
 
+    def tag_regex(self, node):
+        if isinstance(node, MacroTagNode):
+            return self.macro_registry.get(node.macro)
+        elif isinstance(node, RegexTagNode):
+            return node.regex
+        elif isinstance(node, SegmentTagNode):
+            return segment_regex(node.min, node.max)
+        else:
+            return '.+'
+
+def segment_regex(min, max):
+    """
+        regex matching between min and max path segments; max of None
+        means no upper bound
+    """
+    if max == 1:
+        return '[^/]+'
+    if max is None:
+        repeat = '{%d,}' % (min - 1)
+    elif min == max:
+        repeat = '{%d}' % (min - 1)
+    else:
+        repeat = '{%d,%d}' % (min - 1, max - 1)
+    return '[^/]+(?:/[^/]+)' + repeat
+
+# characters that let raw text around an optional form a character class,
+# a counted repeat or an escape together with the text on its other side
+UNSAFE_TEXT = '[]{}\\'
+
+def raw_text(node):
+    """
+        the part of a node's regex written by the user and passed through
+        unchanged: the token of a TextNode or the regex of an unnamed
+        RegexTagNode
+    """
+    if isinstance(node, TextNode):
+        return node.token
+    if isinstance(node, RegexTagNode) and not node.name:
+        return node.regex
+    return ''
+
+def canonicalize(node_list, macro_registry=DefaultMacroRegistry(),
+                 unsafe=False):
+    """
+        return an equivalent node list in which every tag is a RegexTagNode
+        with its macro resolved, empty and doubly nested optionals are
+        removed, and adjacent TextNodes are merged. Surlexes with equal
+        canonical node lists translate to the same regex.
+
+        TextNodes are raw regex, so an optional is left exactly as it is
+        when the text after it starts with a quantifier (which applies to
+        the optional), or when raw text at its level or around it holds
+        one of []{}\\ and so could join up with the text on its other
+        side once it is gone.
+    """
+    unsafe = unsafe or any(char in raw_text(node)
+                           for node in node_list for char in UNSAFE_TEXT)
+    scribe = RegexScribe([], macro_registry)
+    output = []
+    for i, node in enumerate(node_list):
+        if isinstance(node, OptionalNode):
+            following = RegexScribe(node_list[i + 1:i + 2], macro_registry)
+            if unsafe or following.translate()[:1] in ('?', '*', '+', '{'):
+                output.append(node)
+                continue
+            inner = canonicalize(node.node_list, macro_registry)
+            if not inner:
+                # () can only ever match the empty string
+                continue
+            elif len(inner) == 1 and isinstance(inner[0], OptionalNode):
+                # ((x)) is the same as (x)
+                node = inner[0]
+            else:
+                node = OptionalNode(inner)
+        elif isinstance(node, TagNode):
+            node = RegexTagNode(node.name, scribe.tag_regex(node))
+        if (isinstance(node, TextNode) and output and
+                isinstance(output[-1], TextNode)):
+            node = TextNode(output.pop().token + node.token)
+        output.append(node)
+    return output
+
+# characters that have a meaning to re when they appear in a TextNode
+REGEX_METACHARACTERS = '^$|?*+()[]{}\\'
+
+def literal_prefix(node_list, macro_registry=DefaultMacroRegistry()):
+    """
+        the leading text every subject matching node_list must start with
+    """
+    if not node_list or not isinstance(node_list[0], TextNode):
+        return ''
+    for node in node_list:
+        # a top-level alternation means there is no common prefix
+        if isinstance(node, TextNode):
+            regex = node.token
+        elif isinstance(node, RegexTagNode) and not node.name:
+            regex = node.regex
+        elif isinstance(node, MacroTagNode) and not node.name:
+            regex = macro_registry.get(node.macro)
+        else:
+            continue
+        if '|' in regex:
+            return ''
+    token = node_list[0].token
+    if token.startswith('^'):
+        token = token[1:]
+    # a quantifier applies to the character before it, and the regex of
+    # the next node can start with one
+    following = RegexScribe(node_list[1:2], macro_registry).translate()
+    lookahead = token + following[:1]
+    prefix = ''
+    for i, char in enumerate(token):
+        if char in REGEX_METACHARACTERS:
+            break
+        if lookahead[i + 1:i + 2] in ('?', '*', '+', '{'):
+            break
+        prefix += char
+    return prefix
+
 def get_all_nodes(node_list):
     for node in node_list:
         if isinstance(node, BlockNode):
@@ -0,0 +1,163 @@
+"""
+    Attribute the match time of a surlex to the nodes it is made of.
+
+    Every node outside of an optional block, and every node inside one, is
+    profiled on its own and charged two costs:
+
+        own             the time the node adds when the pattern is cut off
+                        after it, with every wildcard, tag and macro atomic
+                        so that none of them can be backtracked into; the
+                        first node is measured against an empty pattern
+        backtracking    the time saved on the full pattern when only this
+                        node is made atomic, i.e. the time the regex engine
+                        spends backtracking into it
+
+    A failure late in the pattern is therefore charged to the greedy
+    wildcards, tags and macros before it that the engine backtracks into,
+    not to the node that failed. Atomic groups are emulated with a
+    lookahead and a backreference, which works on every version of re.
+"""
+import re
+from timeit import default_timer
+
+from surlex.grammar import Parser, RegexScribe, OptionalNode, TextNode, \
+    get_all_nodes
+from surlex.macros import DefaultMacroRegistry
+
+class NodeProfile(object):
+    def __init__(self, node, regex, own, backtracking, share):
+        self.node = node
+        self.regex = regex
+        self.own = own
+        self.backtracking = backtracking
+        self.share = share
+
+    @property
+    def kind(self):
+        return self.node.__class__.__name__
+
+    @property
+    def cost(self):
+        return self.own + self.backtracking
+
+    def __repr__(self):
+        return '<NodeProfile %s: %.6f>' % (self.kind, self.cost)
+
+class Profile(object):
+    def __init__(self, surlex, nodes, total, baseline=0.0):
+        self.surlex = surlex
+        self.nodes = nodes
+        self.total = total
+        # the time the harness takes to match an empty pattern
+        self.baseline = baseline
+
+    def hot_spots(self, threshold=0.25):
+        """
+            nodes taking at least threshold of the total cost, costliest first
+        """
+        hot = [node for node in self.nodes if node.share >= threshold]
+        return sorted(hot, key=lambda node: node.cost, reverse=True)
+
+    def report(self, threshold=0.25):
+        lines = ['%-20s %-30s %12s %12s %7s' % (
+            'node', 'regex', 'own', 'backtracking', 'share')]
+        for node in self.nodes:
+            if node.share >= threshold:
+                marker = ' *'
+            else:
+                marker = ''
+            lines.append('%-20s %-30s %12.6f %12.6f %6.1f%%%s' % (
+                node.kind, node.regex, node.own, node.backtracking,
+                node.share * 100, marker))
+        lines.append('%-20s %-30s %12.6f' % ('baseline', '', self.baseline))
+        lines.append('%-20s %-30s %12.6f' % ('total', '', self.total))
+        return '\n'.join(lines)
+
+def atomic(regex, number):
+    return '(?=(?P<_atomic%d>%s))(?P=_atomic%d)' % (number, regex, number)
+
+def translate_variant(node_list, macro_registry, atomic_leaves, stop,
+                      counter=None):
+    """
+        translate node_list, wrapping the leaf nodes whose positions are in
+        atomic_leaves in atomic groups and cutting the pattern off after
+        leaf number stop
+    """
+    if counter is None:
+        counter = [0]
+    output = ''
+    for node in node_list:
+        if stop is not None and counter[0] > stop:
+            break
+        if isinstance(node, OptionalNode):
+            output += '(' + translate_variant(
+                node.node_list, macro_registry, atomic_leaves, stop, counter,
+            ) + ')?'
+        else:
+            regex = RegexScribe([node], macro_registry).translate()
+            if counter[0] in atomic_leaves:
+                regex = atomic(regex, counter[0])
+            output += regex
+            counter[0] += 1
+    return output
+
+def time_regex(regex, corpus, number, repeat):
+    compiled = re.compile(regex)
+    match = compiled.match
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        for j in range(number):
+            for subject in corpus:
+                match(subject)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def profile_surlex(surlex, corpus, macro_registry=DefaultMacroRegistry(),
+                   number=100, repeat=3):
+    """
+        match the variants of surlex against every subject in corpus number
+        times, keeping the best of repeat runs
+    """
+    node_list = Parser(surlex).get_node_list()
+    leaves = list(get_all_nodes(node_list))
+    # literal text cannot be backtracked into, and wrapping it would only
+    # charge it the cost of the atomic group
+    variable = set(i for i, leaf in enumerate(leaves)
+                   if not isinstance(leaf, TextNode))
+
+    def time_variant(atomic_leaves, stop=None):
+        variant = translate_variant(node_list, macro_registry, atomic_leaves,
+                                    stop)
+        return time_regex(variant, corpus, number, repeat)
+
+    # the loop and one match() call per subject cost time whatever the
+    # pattern, so the first node is measured against an empty pattern
+    baseline = time_regex('', corpus, number, repeat)
+    total = time_variant(set())
+    # timing noise can make a variant faster than the one it is compared to
+    owns = []
+    previous = baseline
+    for i in range(len(leaves)):
+        cumulative = time_variant(variable, i)
+        owns.append(max(cumulative - previous, 0.0))
+        previous = cumulative
+    backtrackings = []
+    for i, leaf in enumerate(leaves):
+        if isinstance(leaf, TextNode):
+            backtrackings.append(0.0)
+        else:
+            backtrackings.append(max(total - time_variant(set([i])), 0.0))
+    spent = sum(owns) + sum(backtrackings)
+
+    nodes = []
+    for leaf, own, backtracking in zip(leaves, owns, backtrackings):
+        if spent:
+            share = (own + backtracking) / spent
+        else:
+            share = 0.0
+        regex = RegexScribe([leaf], macro_registry).translate()
+        nodes.append(NodeProfile(leaf, regex, own, backtracking, share))
+    return Profile(surlex, nodes, total, baseline)
@@ -0,0 +1,286 @@
+"""
+    A translated route table that can be built once and memory-mapped.
+
+    A pre-fork server can translate its surlexes in the master process with
+    dump_route_table() and have every worker open the resulting file with
+    RouteTable.open(). The file is mapped read-only, so its pages are shared
+    between workers, and each route's regex is only compiled by a worker the
+    first time that route is tried. The file also holds the routes sorted
+    by literal prefix, which is searched in place, so a match only tries
+    the routes whose prefix the subject starts with and no worker keeps a
+    copy of the prefixes.
+
+    File layout (all integers are little-endian unsigned 32 bit):
+
+        magic               8 bytes, "SURLEX2\\0"
+        encoding            16 bytes, NUL padded; empty for text routes
+        count               number of routes
+        max prefix          length in bytes of the longest literal prefix
+        index               count * (prefix offset, prefix length,
+                                     record offset, record length)
+        prefix order        count * route number, sorted by prefix bytes
+        data                literal prefixes and JSON records
+
+    Offsets are relative to the start of the file. Each record holds the
+    surlex, its canonical regex source, the group names in order and the
+    macro of each macro tag.
+"""
+import json
+import mmap
+import struct
+
+from surlex import SurlexMatch, buffer_groupdict, compile_regex
+from surlex.exceptions import MalformedRouteTable
+from surlex.grammar import Parser, RegexScribe, TagNode, MacroTagNode, \
+    canonicalize, get_all_nodes, literal_prefix, check_encoding
+from surlex.macros import DefaultMacroRegistry
+
+MAGIC = b'SURLEX2\0'
+ENCODING_SIZE = 16
+HEADER = struct.Struct('<8s%dsII' % ENCODING_SIZE)
+INDEX_ENTRY = struct.Struct('<IIII')
+ORDER_ENTRY = struct.Struct('<I')
+
+def build_route_table(surlexes, macro_registry=DefaultMacroRegistry(),
+                      encoding=None):
+    """
+        translate surlexes and return the route table as bytes
+    """
+    encoding_name = (encoding or '').encode('ascii')
+    if len(encoding_name) > ENCODING_SIZE:
+        raise MalformedRouteTable(
+            'Malformed route table. Encoding name %s is too long.' % encoding)
+    check_encoding(encoding)
+    prefixes = []
+    records = []
+    for surlex in surlexes:
+        # regexes are only compiled by the workers, on first use
+        node_list = Parser(surlex).get_node_list()
+        regex = RegexScribe(canonicalize(node_list, macro_registry),
+                            macro_registry).translate()
+        tags = [node for node in get_all_nodes(node_list)
+                if isinstance(node, TagNode)]
+        prefix = literal_prefix(node_list, macro_registry)
+        prefixes.append(prefix.encode(encoding or 'utf-8'))
+        records.append(json.dumps({
+            'surlex': surlex,
+            'regex': regex,
+            'groups': [node.name for node in tags if node.name],
+            'macros': dict((node.name, node.macro) for node in tags
+                           if isinstance(node, MacroTagNode)),
+        }, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+
+    order = sorted(range(len(prefixes)), key=lambda i: (prefixes[i], i))
+    offset = (HEADER.size + INDEX_ENTRY.size * len(records) +
+              ORDER_ENTRY.size * len(records))
+    index = []
+    data = []
+    for prefix, record in zip(prefixes, records):
+        index.append(INDEX_ENTRY.pack(
+            offset, len(prefix), offset + len(prefix), len(record)))
+        data.append(prefix)
+        data.append(record)
+        offset += len(prefix) + len(record)
+    max_prefix = max([len(prefix) for prefix in prefixes] or [0])
+    header = HEADER.pack(MAGIC, encoding_name, len(records), max_prefix)
+    return (header + b''.join(index) +
+            b''.join(ORDER_ENTRY.pack(i) for i in order) + b''.join(data))
+
+def dump_route_table(surlexes, path, macro_registry=DefaultMacroRegistry(),
+                     encoding=None):
+    """
+        translate surlexes and write the route table to path
+    """
+    table = build_route_table(surlexes, macro_registry, encoding)
+    f = open(path, 'wb')
+    try:
+        f.write(table)
+    finally:
+        f.close()
+
+class RouteTable(object):
+    """
+        read-only view of a route table; routes are tried in order and the
+        first match wins
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+        if len(buffer) < HEADER.size:
+            raise MalformedRouteTable('Malformed route table. Too short.')
+        magic, encoding, self.count, self.max_prefix = HEADER.unpack_from(
+            buffer, 0)
+        if magic != MAGIC:
+            raise MalformedRouteTable('Malformed route table. Bad magic.')
+        self.encoding = encoding.rstrip(b'\0').decode('ascii') or None
+        self.order_start = HEADER.size + INDEX_ENTRY.size * self.count
+        self.data_start = self.order_start + ORDER_ENTRY.size * self.count
+        if len(buffer) < self.data_start:
+            raise MalformedRouteTable('Malformed route table. Truncated.')
+        self.records = {}
+        self.compiled = {}
+        # routes with the same canonical regex share one compiled regex;
+        # the cache is bounded by the size of the table
+        self.compiled_regexes = {}
+
+    @classmethod
+    def open(cls, path):
+        f = open(path, 'rb')
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        return cls(buffer)
+
+    def __len__(self):
+        return self.count
+
+    def index_entry(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError('route index out of range')
+        entry = INDEX_ENTRY.unpack_from(
+            self.buffer, HEADER.size + INDEX_ENTRY.size * i)
+        prefix_offset, prefix_length, record_offset, record_length = entry
+        for offset, length in ((prefix_offset, prefix_length),
+                               (record_offset, record_length)):
+            if (offset < self.data_start or
+                    offset + length > len(self.buffer)):
+                raise MalformedRouteTable(
+                    'Malformed route table. Route %d out of bounds.' % i)
+        return entry
+
+    def prefix_bytes(self, i):
+        offset, length, _, _ = self.index_entry(i)
+        return self.buffer[offset:offset + length]
+
+    def prefix(self, i):
+        prefix = self.prefix_bytes(i)
+        if not self.encoding:
+            try:
+                prefix = prefix.decode('utf-8')
+            except UnicodeDecodeError:
+                raise MalformedRouteTable(
+                    'Malformed route table. Bad prefix for route %d.' % i)
+        return prefix
+
+    def record(self, i):
+        if i not in self.records:
+            _, _, offset, length = self.index_entry(i)
+            try:
+                self.records[i] = json.loads(
+                    self.buffer[offset:offset + length].decode('utf-8'))
+            except ValueError:
+                raise MalformedRouteTable(
+                    'Malformed route table. Bad record for route %d.' % i)
+        return self.records[i]
+
+    def sorted_route(self, position):
+        """
+            the route at position in prefix order
+        """
+        route = ORDER_ENTRY.unpack_from(
+            self.buffer, self.order_start + ORDER_ENTRY.size * position)[0]
+        if route >= self.count:
+            raise MalformedRouteTable(
+                'Malformed route table. Bad prefix order at %d.' % position)
+        return route
+
+    def bisect(self, key, lo, hi, right):
+        """
+            bisect_left, or bisect_right if right is set, for key among
+            the prefixes in prefix order, reading them from the buffer
+        """
+        while lo < hi:
+            mid = (lo + hi) // 2
+            prefix = self.prefix_bytes(self.sorted_route(mid))
+            if prefix < key or (right and prefix == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def candidates(self, subject):
+        """
+            indexes, in table order, of the routes whose literal prefix
+            the subject starts with
+        """
+        if self.encoding:
+            key = bytes(subject[:self.max_prefix])
+        else:
+            key = subject[:self.max_prefix].encode('utf-8')
+        found = []
+        hi = self.count
+        while hi:
+            # the greatest prefix not after key is either a prefix of key,
+            # or shares a shorter common prefix with it that is searched next
+            end = self.bisect(key, 0, hi, True)
+            if not end:
+                break
+            prefix = self.prefix_bytes(self.sorted_route(end - 1))
+            if key.startswith(prefix):
+                start = self.bisect(prefix, 0, end, False)
+                found.extend(self.sorted_route(position)
+                             for position in range(start, end))
+                if not prefix:
+                    break
+                key = prefix[:-1]
+                hi = start
+            else:
+                common = 0
+                while prefix[common] == key[common]:
+                    common += 1
+                key = key[:common]
+                hi = end - 1
+        found.sort()
+        return found
+
+    def regex(self, i):
+        """
+            the compiled regex of route i, compiled on first use
+        """
+        if i not in self.compiled:
+            regex = self.record(i)['regex']
+            if self.encoding:
+                regex = regex.encode(self.encoding)
+            self.compiled[i] = compile_regex(
+                regex, self.compiled_regexes, None)
+        return self.compiled[i]
+
+    def regex_match(self, subject):
+        for i in self.candidates(subject):
+            m = self.regex(i).match(subject)
+            if m:
+                return i, m
+        return None, None
+
+    def match_index(self, subject):
+        """
+            the index of the first route matching subject, or None
+        """
+        return self.regex_match(subject)[0]
+
+    def match(self, subject):
+        """
+            (index, groupdict) for the first route matching subject
+        """
+        i, m = self.regex_match(subject)
+        if m:
+            if self.encoding:
+                return i, buffer_groupdict(m, subject)
+            return i, m.groupdict()
+
+    def match_spans(self, subject):
+        """
+            (index, spans) for the first route matching subject, with the
+            (start, end) offset of each capture as in Surlex.match_spans
+        """
+        i, m = self.regex_match(subject)
+        if m:
+            return i, dict((name, m.span(name)) for name in m.re.groupindex)
+
+    def match_lazy(self, subject):
+        """
+            (index, SurlexMatch) for the first route matching subject
+        """
+        i, m = self.regex_match(subject)
+        if m:
+            return i, SurlexMatch(m, subject, self.encoding)
@@ -1,8 +1,20 @@
 import unittest
-from surlex import surlex_to_regex as surl, match, register_macro, parsed_surlex_object, Surlex, MacroRegistry
+from surlex import surlex_to_regex as surl, match, register_macro, parsed_surlex_object, Surlex, MacroRegistry, MultiSurlex
 from surlex import grammar
 from surlex.exceptions import MalformedSurlex, MacroDoesNotExist
+import surlex
+from surlex import routetable, profiler
+from surlex.exceptions import MalformedRouteTable, BadEncoding
+import os
+import random
 import re
+import shutil
+import tempfile
+from timeit import default_timer
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 class TestGrammer(unittest.TestCase):
     def test_parser_simple(self):
@@ -113,6 +125,41 @@ class TestGrammer(unittest.TestCase):
             ]
         )
 
+    def test_segment_wildcard(self):
+        self.assertEqual(
+            grammar.Parser('/<*>/').get_node_list(),
+            [grammar.TextNode('/'), grammar.SegmentWildcardNode(), grammar.TextNode('/')],
+        )
+
+    def test_segment_tag(self):
+        self.assertEqual(
+            grammar.Parser('<test/>').get_node_list(),
+            [grammar.SegmentTagNode('test')]
+        )
+
+    def test_segment_repeat_tag(self):
+        self.assertEqual(
+            grammar.Parser('<a/{2}><b/{1,3}><c/{2,}></{4}>').get_node_list(),
+            [
+                grammar.SegmentTagNode('a', 2, 2),
+                grammar.SegmentTagNode('b', 1, 3),
+                grammar.SegmentTagNode('c', 2, None),
+                grammar.SegmentTagNode('', 4, 4),
+            ]
+        )
+
+    def test_segment_repeat_malformed(self):
+        for surlex in ('<a/x>', '<a/{0}>', '<a/{3,2}>', '<a/{,2}>',
+                       '<a/{9999999999}>', '<a/{1,9999999999}>',
+                       '<a/{9999999999,}>'):
+            self.assertRaises(MalformedSurlex, grammar.Parser(surlex).get_node_list)
+
+    def test_segment_repeat_limit(self):
+        limit = grammar.MAXREPEAT
+        node_list = grammar.Parser('<a/{1,%d}>' % limit).get_node_list()
+        self.assertEqual(node_list, [grammar.SegmentTagNode('a', 1, limit)])
+        re.compile(grammar.RegexScribe(node_list).translate())
+
 class TestRegexScribe(unittest.TestCase):
     def test_basic(self):
         node_list = [grammar.TextNode('test')]
@@ -175,6 +222,94 @@ class TestRegexScribe(unittest.TestCase):
             r'\d{4}',
         )
 
+    def test_segment_wildcard(self):
+        node_list = [grammar.SegmentWildcardNode()]
+        self.assertEqual(grammar.RegexScribe(node_list).translate(), '[^/]*')
+
+    def test_segment_tag(self):
+        node_list = [
+            grammar.SegmentTagNode('one'),
+            grammar.SegmentTagNode('two', 2, 2),
+            grammar.SegmentTagNode('', 1, 3),
+            grammar.SegmentTagNode('many', 2, None),
+        ]
+        self.assertEqual(
+            grammar.RegexScribe(node_list).translate(),
+            '(?P<one>[^/]+)'
+            '(?P<two>[^/]+(?:/[^/]+){1})'
+            '[^/]+(?:/[^/]+){0,2}'
+            '(?P<many>[^/]+(?:/[^/]+){1,})',
+        )
+
+class TestCanonicalize(unittest.TestCase):
+    def canonical(self, surlex, macro_registry=None):
+        node_list = grammar.Parser(surlex).get_node_list()
+        if macro_registry is None:
+            return grammar.canonicalize(node_list)
+        return grammar.canonicalize(node_list, macro_registry)
+
+    def test_merge_text(self):
+        self.assertEqual(self.canonical('a()b'), [grammar.TextNode('ab')])
+
+    def test_empty_optional(self):
+        self.assertEqual(
+            self.canonical('/a/((())(()))'),
+            [grammar.TextNode('/a/')],
+        )
+
+    def test_nested_optional(self):
+        self.assertEqual(
+            self.canonical('/a/((b))'),
+            [grammar.TextNode('/a/'), grammar.OptionalNode([grammar.TextNode('b')])],
+        )
+
+    def test_resolve_tags(self):
+        registry = MacroRegistry({'int': r'\d+'})
+        self.assertEqual(
+            self.canonical('<a><b:int><c/><d=x>', registry),
+            [
+                grammar.RegexTagNode('a', '.+'),
+                grammar.RegexTagNode('b', r'\d+'),
+                grammar.RegexTagNode('c', '[^/]+'),
+                grammar.RegexTagNode('d', 'x'),
+            ]
+        )
+
+    def test_shared_compiled(self):
+        a = Surlex('/<id:#>/(())')
+        b = Surlex('/<id=\d+>/')
+        self.assertNotEqual(a.to_regex, b.to_regex)
+        self.assertEqual(a.canonical, b.canonical)
+        self.assertTrue(a.compile() is b.compile())
+        self.assertEqual(a.match('/12/'), {'id': '12'})
+
+    def test_quantified_optional(self):
+        for text, subjects in (('a()?b', ['b', 'ab']), ('x()+y', ['y', 'xy']),
+                               ('a()<=?>b', ['b', 'ab']),
+                               ('x{2()}', ['x{2}', 'xx']),
+                               ('[a()]', ['(', 'a'])):
+            obj = Surlex(text)
+            self.assertEqual(obj.to_regex, obj.canonical)
+            for subject in subjects:
+                self.assertEqual(obj.matches(subject),
+                                 re.match(obj.to_regex, subject) is not None)
+
+    def test_compiled_cache_bounded(self):
+        cache = {}
+        for i in range(10):
+            surlex.compile_regex('/r%d/' % i, cache, 4)
+        self.assertEqual(len(cache), 4)
+        self.assertTrue('/r9/' in cache)
+        first = surlex.compile_regex('/r9/', cache, 4)
+        self.assertTrue(surlex.compile_regex('/r9/', cache, 4) is first)
+
+    def test_compiled_cache_unbounded(self):
+        cache = {}
+        first = [surlex.compile_regex('/r%d/' % i, cache) for i in range(600)]
+        for i in range(600):
+            self.assertTrue(surlex.compile_regex('/r%d/' % i, cache)
+                            is first[i])
+
 class TestSurlex(unittest.TestCase):
     def setUp(self):
         # matches are pairs of surl expressions and the regex equivalent
@@ -271,5 +406,600 @@ class TestSurlex(unittest.TestCase):
         self.assertEqual(m['year'], '2008')
         self.assertEqual(m['slug'], 'this-article')
 
+    def test_match_segments(self):
+        surlex = Surlex('/<section/>/<path/{1,2}>/<*>$')
+        self.assertEqual(
+            surlex.match('/docs/a/b/c.html'),
+            {'section': 'docs', 'path': 'a/b'},
+        )
+        self.assertEqual(surlex.match('/docs/a/b/c/d.html'), None)
+        self.assertEqual(surlex.match('/docs/a'), None)
+
+class TestMatchResults(unittest.TestCase):
+    def setUp(self):
+        self.surlex = Surlex('/articles/<year:Y>/(<slug:s>/)')
+
+    def test_matches(self):
+        self.assertTrue(self.surlex.matches('/articles/2008/this-article/'))
+        self.assertFalse(self.surlex.matches('/articles/this-article/'))
+
+    def test_match_spans(self):
+        spans = self.surlex.match_spans('/articles/2008/this-article/')
+        self.assertEqual(spans, {'year': (10, 14), 'slug': (15, 27)})
+        spans = self.surlex.match_spans('/articles/2008/')
+        self.assertEqual(spans['slug'], (-1, -1))
+        self.assertEqual(self.surlex.match_spans('/other/'), None)
+
+    def test_translate_without_compiling(self):
+        surlex = Surlex('/<a=(>')
+        self.assertEqual(surlex.to_regex, '/(?P<a>()')
+        self.assertEqual(surlex.compiled, None)
+        self.assertRaises(re.error, surlex.match, '/(')
+
+    def test_match_lazy(self):
+        m = self.surlex.match_lazy('/articles/2008/')
+        self.assertEqual(m['year'], '2008')
+        self.assertEqual(m['slug'], None)
+        self.assertEqual(m.get('missing', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: m['missing'])
+        self.assertRaises(KeyError, m.span, 'missing')
+        self.assertEqual(m.span('year'), (10, 14))
+        self.assertEqual(sorted(m.keys()), ['slug', 'year'])
+        self.assertEqual(self.surlex.match_lazy('/other/'), None)
+
+    def test_match_lazy_bytes(self):
+        surlex = Surlex('/articles/<year:Y>/', encoding='ascii')
+        m = surlex.match_lazy(b'/articles/2008/')
+        self.assertEqual(m['year'].tobytes(), b'2008')
+
+class TestMultiSurlex(unittest.TestCase):
+    def setUp(self):
+        self.surlex = MultiSurlex({
+            'host': '<subdomain/>.example.com',
+            'path': '/articles/<year:Y>/',
+            'query': {'page': '<page:#>', 'format': 'json'},
+        })
+
+    def test_match(self):
+        self.assertEqual(
+            self.surlex.match({
+                'host': 'blog.example.com',
+                'path': '/articles/2008/',
+                'query': 'page=3&format=json&utm=x',
+            }),
+            {'subdomain': 'blog', 'year': '2008', 'page': '3'},
+        )
+
+    def test_match_query_dict(self):
+        self.assertEqual(
+            self.surlex.match({
+                'host': 'blog.example.com',
+                'path': '/articles/2008/',
+                'query': {'page': ['3', '4'], 'format': 'json'},
+            }),
+            {'subdomain': 'blog', 'year': '2008', 'page': '3'},
+        )
+
+    def test_no_match(self):
+        subject = {
+            'host': 'blog.example.com',
+            'path': '/articles/2008/',
+            'query': 'page=3&format=json',
+        }
+        for field, value in (('host', 'example.org'), ('path', '/other/'),
+                             ('query', 'page=3&format=xml'), ('query', 'page=3')):
+            changed = dict(subject)
+            changed[field] = value
+            self.assertEqual(self.surlex.match(changed), None)
+        del subject['host']
+        self.assertEqual(self.surlex.match(subject), None)
+
+    def test_cheapest_first(self):
+        surlex = MultiSurlex({
+            'host': 'example.com',
+            'path': '/<a>/<b>/',
+            'scheme': '<scheme=https?>',
+            'query': {'q': '<q>', 'format': 'json'},
+        })
+        surlex.translate()
+        self.assertEqual(
+            [(field, param) for field, param, literal, s in surlex.checks],
+            [('host', None), ('scheme', None), ('path', None),
+             ('query', 'format'), ('query', 'q')],
+        )
+
+    def test_malformed_fields(self):
+        self.assertRaises(MalformedSurlex, MultiSurlex, {'query': 'a=<a>'})
+        self.assertRaises(MalformedSurlex, MultiSurlex, {'path': {'a': '<a>'}})
+        self.assertRaises(MalformedSurlex, MultiSurlex, ['/<a>/'])
+
+    def test_duplicate_capture(self):
+        surlex = MultiSurlex({'host': '<name>.com', 'path': '/<name>/'})
+        self.assertRaises(MalformedSurlex, surlex.translate)
+
+class TestBytes(unittest.TestCase):
+    def test_bytes_regex(self):
+        surlex = Surlex('/blog/<year:Y>.html', encoding='ascii')
+        self.assertEqual(surlex.translate(), br'/blog/(?P<year>\d{4})\.html')
+
+    def test_bytes_optional_macro(self):
+        registry = MacroRegistry({'int': r'[0-9]'})
+        surlex = Surlex('/things/(<id:int>/)', registry, encoding='ascii')
+        self.assertEqual(surlex.translate(), br'/things/((?P<id>[0-9])/)?')
+
+    def test_bytes_match(self):
+        surlex = Surlex('/articles/<year:Y>/(<slug:s>/)', encoding='ascii')
+        m = surlex.match(b'/articles/2008/this-article/')
+        self.assertEqual(m['year'].tobytes(), b'2008')
+        self.assertEqual(m['slug'].tobytes(), b'this-article')
+        self.assertEqual(surlex.match(b'/articles/2008/')['slug'], None)
+        self.assertEqual(surlex.match(b'/other/'), None)
+
+    def test_bad_encoding(self):
+        for encoding in ('utf-16', 'utf-32', 'cp500', 'no-such-codec'):
+            self.assertRaises(BadEncoding, Surlex, '/a', encoding=encoding)
+            self.assertRaises(BadEncoding, grammar.RegexScribe, [], encoding=encoding)
+        self.assertEqual(Surlex('/a', encoding='utf-8').translate(), b'/a')
+        self.assertEqual(Surlex('/a', encoding='latin-1').translate(), b'/a')
+
+    def test_memoryview_match(self):
+        subject = bytearray(b'/articles/2008/')
+        m = Surlex('/articles/<year:Y>/', encoding='ascii').match(memoryview(subject))
+        self.assertTrue(isinstance(m['year'], memoryview))
+        subject[10:14] = b'1999'
+        self.assertEqual(m['year'].tobytes(), b'1999')
+
+class TestRouteTable(unittest.TestCase):
+    def setUp(self):
+        self.surlexes = [
+            '/articles/<year:Y>/(<slug:s>/)',
+            '/articles/archive/',
+            '/<page>/',
+        ]
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'routes.table')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_literal_prefix(self):
+        def prefix(surlex):
+            return grammar.literal_prefix(grammar.Parser(surlex).get_node_list())
+        self.assertEqual(prefix('/articles/<year:Y>/'), '/articles/')
+        self.assertEqual(prefix('^/a.html'), '/a.html')
+        self.assertEqual(prefix('/ab?c'), '/a')
+        self.assertEqual(prefix('/a|/b'), '')
+        self.assertEqual(prefix('/a<=b|c>'), '')
+        self.assertEqual(prefix('<page>/'), '')
+        self.assertEqual(prefix('/ab<=?>c'), '/a')
+        self.assertEqual(prefix('/ab<x>'), '/ab')
+
+    def test_match(self):
+        table = routetable.RouteTable(routetable.build_route_table(self.surlexes))
+        self.assertEqual(len(table), 3)
+        self.assertEqual(
+            table.match('/articles/2008/this-article/'),
+            (0, {'year': '2008', 'slug': 'this-article'}),
+        )
+        self.assertEqual(table.match_index('/articles/archive/'), 1)
+        self.assertEqual(table.match('/about/'), (2, {'page': 'about'}))
+        self.assertEqual(table.match('nothing'), None)
+        self.assertEqual(table.match_index('nothing'), None)
+
+    def test_match_order_across_prefixes(self):
+        table = routetable.RouteTable(routetable.build_route_table(
+            ['/<a>/', '/articles/<b>/', '/ab<=?>c']))
+        self.assertEqual(table.match('/articles/x/'), (0, {'a': 'articles/x'}))
+        self.assertEqual(table.match_index('/ac'), 2)
+        self.assertEqual(table.candidates('/articles/x/'), [0, 1, 2])
+        self.assertEqual(table.candidates('/x/'), [0])
+
+    def test_match_modes(self):
+        table = routetable.RouteTable(routetable.build_route_table(self.surlexes))
+        self.assertEqual(
+            table.match_spans('/articles/2008/'),
+            (0, {'year': (10, 14), 'slug': (-1, -1)}),
+        )
+        i, m = table.match_lazy('/about/')
+        self.assertEqual((i, m['page']), (2, 'about'))
+        self.assertEqual(table.match_spans('nothing'), None)
+        self.assertEqual(table.match_lazy('nothing'), None)
+
+    def test_candidates(self):
+        rand = random.Random(STRESS_SEED)
+        for i in range(50):
+            surlexes = [''.join(rand.choice('ab/') for k in range(rand.randint(0, 4))) + '<x>'
+                        for j in range(rand.randint(0, 12))]
+            table = routetable.RouteTable(routetable.build_route_table(surlexes))
+            for j in range(20):
+                subject = ''.join(rand.choice('ab/') for k in range(rand.randint(0, 6)))
+                self.assertEqual(
+                    table.candidates(subject),
+                    [k for k in range(len(table)) if subject.startswith(table.prefix(k))],
+                )
+
+    def test_build_does_not_compile(self):
+        data = routetable.build_route_table(['/<a=(>/', '/<b>/'])
+        table = routetable.RouteTable(data)
+        self.assertEqual(table.record(0)['groups'], ['a'])
+        self.assertRaises(re.error, table.match, '/x/')
+
+    def test_lazy_compile(self):
+        table = routetable.RouteTable(routetable.build_route_table(self.surlexes))
+        table.match('/about/')
+        self.assertEqual(sorted(table.compiled), [2])
+
+    def test_record(self):
+        table = routetable.RouteTable(routetable.build_route_table(self.surlexes))
+        record = table.record(0)
+        self.assertEqual(record['surlex'], self.surlexes[0])
+        self.assertEqual(record['regex'], surl(self.surlexes[0]))
+        self.assertEqual(record['groups'], ['year', 'slug'])
+        self.assertEqual(record['macros'], {'year': 'Y', 'slug': 's'})
+
+    def test_mmap(self):
+        routetable.dump_route_table(self.surlexes, self.path, encoding='ascii')
+        table = routetable.RouteTable.open(self.path)
+        i, m = table.match(b'/articles/2008/')
+        self.assertEqual(i, 0)
+        self.assertEqual(m['year'].tobytes(), b'2008')
+        self.assertEqual(m['slug'], None)
+        self.assertEqual(table.match_index(memoryview(b'/about/')), 2)
+        table.buffer.close()
+
+    def test_malformed(self):
+        self.assertRaises(MalformedRouteTable, routetable.RouteTable, b'SURLEX')
+        self.assertRaises(MalformedRouteTable, routetable.RouteTable, b'x' * 28)
+
+    def test_corrupt_index(self):
+        data = routetable.build_route_table(self.surlexes)
+        entry = routetable.HEADER.size
+        corrupt = (data[:entry + 12] + routetable.struct.pack('<I', 10 ** 6) +
+                   data[entry + 16:])
+        table = routetable.RouteTable(corrupt)
+        self.assertRaises(MalformedRouteTable, table.record, 0)
+        self.assertRaises(MalformedRouteTable, table.match, '/about/')
+        garbled = data[:-3] + b'}}}'
+        table = routetable.RouteTable(garbled)
+        self.assertRaises(MalformedRouteTable, table.record, 2)
+
+    def test_long_encoding_name(self):
+        self.assertRaises(MalformedRouteTable, routetable.build_route_table,
+                          self.surlexes, encoding='x' * 17)
+
+class TestProfiler(unittest.TestCase):
+    def test_profile(self):
+        corpus = ['/articles/2008/this-article/', '/other/']
+        profile = profiler.profile_surlex('/articles/<year:Y>/(<slug>/)',
+                                          corpus, number=1, repeat=1)
+        self.assertEqual(
+            [node.kind for node in profile.nodes],
+            ['TextNode', 'MacroTagNode', 'TextNode', 'TagNode', 'TextNode'],
+        )
+        self.assertEqual(profile.nodes[1].regex, r'(?P<year>\d{4})')
+        self.assertEqual(profile.nodes[3].regex, '(?P<slug>.+)')
+        for node in profile.nodes:
+            self.assertTrue(node.own >= 0)
+            self.assertTrue(node.backtracking >= 0)
+            self.assertTrue(0 <= node.share <= 1)
+        self.assertEqual(profile.nodes[0].backtracking, 0)
+        self.assertTrue('MacroTagNode' in profile.report())
+
+    def test_leading_literal_not_hot(self):
+        corpus = ['/a' + str(10 ** 40 + i) for i in range(20)]
+        profile = profiler.profile_surlex('/a<b:#>', corpus, number=200, repeat=5)
+        self.assertTrue(profile.baseline > 0)
+        self.assertEqual(profile.nodes[0].node, grammar.TextNode('/a'))
+        self.assertFalse(profile.nodes[0] in profile.hot_spots())
+
+    def test_translate_variant(self):
+        node_list = grammar.Parser('/a(<b>/(<c:#>))x').get_node_list()
+        self.assertEqual(
+            profiler.translate_variant(node_list, MacroRegistry(), set([1]), 2),
+            '/a((?=(?P<_atomic1>(?P<b>.+)))(?P=_atomic1)/)?',
+        )
+
+    def test_hot_spots(self):
+        profile = profiler.profile_surlex('/<a>/<b>/x', ['/' + 'a/' * 100],
+                                          number=1, repeat=1)
+        hot = profile.hot_spots()
+        self.assertTrue(hot)
+        for node in hot:
+            self.assertTrue(isinstance(node.node, grammar.TagNode))
+        text = profile.nodes[-1]
+        self.assertEqual(text.node, grammar.TextNode('/x'))
+        self.assertTrue(text.cost < hot[0].cost)
+
+# Stress suite: random surlexes are rendered from random node lists, parsed
+# back and matched both through their regex and through a reference matcher
+# that walks the node list directly, trying alternatives in the same greedy
+# order as the re module. Surlexes whose text holds raw regex metacharacters
+# cannot be walked by the reference matcher, so for those the canonical
+# regex that Surlex.match uses is checked against the original translation
+# instead. SURLEX_STRESS_SEED picks the seed and
+# SURLEX_STRESS_SCALE multiplies every time budget for slow machines.
+
+STRESS_SEED = int(os.environ.get('SURLEX_STRESS_SEED', 1))
+STRESS_SCALE = float(os.environ.get('SURLEX_STRESS_SCALE', 1))
+STRESS_TEXT = 'ab/.-'
+# TextNodes pass these through to the regex as metacharacters
+STRESS_REGEX_TEXT = STRESS_TEXT + '?+{}[]|^$2'
+STRESS_SUBJECT = 'ab/.-19'
+STRESS_MACROS = {'#': '0123456789', 's': 'abcdefghijklmnopqrstuvwxyz0123456789_-'}
+# every character a generated subject can hold except the slash
+STRESS_SEGMENT = ''.join(sorted(set(STRESS_SUBJECT + ''.join(STRESS_MACROS.values())) - set('/')))
+
+def random_node_list(rand, names, depth=0, size=4, text=STRESS_TEXT):
+    node_list = []
+    for i in range(rand.randint(0, size)):
+        kind = rand.choice(['text', 'text', 'wildcard', 'segment_wildcard',
+                            'tag', 'segment_tag', 'macro', 'optional'])
+        if kind == 'text':
+            if node_list and isinstance(node_list[-1], grammar.TextNode):
+                continue
+            token = ''.join(rand.choice(text)
+                            for j in range(rand.randint(1, 3)))
+            node_list.append(grammar.TextNode(token))
+        elif kind == 'wildcard':
+            node_list.append(grammar.WildcardNode())
+        elif kind == 'segment_wildcard':
+            node_list.append(grammar.SegmentWildcardNode())
+        elif kind == 'optional' and depth < 2:
+            node_list.append(grammar.OptionalNode(
+                random_node_list(rand, names, depth + 1, 2, text)))
+        elif kind in ('tag', 'segment_tag', 'macro'):
+            name = rand.choice(['', 'g%d' % len(names)])
+            if name:
+                names.append(name)
+            if kind == 'tag':
+                node_list.append(grammar.TagNode(name))
+            elif kind == 'macro':
+                node_list.append(grammar.MacroTagNode(
+                    name, rand.choice(sorted(STRESS_MACROS))))
+            else:
+                min = rand.randint(1, 2)
+                max = rand.choice([min, min + 1, None])
+                node_list.append(grammar.SegmentTagNode(name, min, max))
+    return node_list
+
+def render(node_list):
+    output = ''
+    for node in node_list:
+        if isinstance(node, grammar.TextNode):
+            output += node.token
+        elif isinstance(node, grammar.WildcardNode):
+            output += '*'
+        elif isinstance(node, grammar.SegmentWildcardNode):
+            output += '<*>'
+        elif isinstance(node, grammar.OptionalNode):
+            output += '(' + render(node.node_list) + ')'
+        elif isinstance(node, grammar.MacroTagNode):
+            output += '<%s:%s>' % (node.name, node.macro)
+        elif isinstance(node, grammar.SegmentTagNode):
+            if node.min == node.max == 1:
+                output += '<%s/>' % node.name
+            elif node.min == node.max:
+                output += '<%s/{%d}>' % (node.name, node.min)
+            else:
+                output += '<%s/{%d,%s}>' % (node.name, node.min,
+                                            node.max or '')
+        elif isinstance(node, grammar.TagNode):
+            output += '<%s>' % node.name
+    return output
+
+def random_subject(rand, node_list):
+    output = ''
+    for node in node_list:
+        if isinstance(node, grammar.TextNode):
+            output += node.token
+        elif isinstance(node, grammar.OptionalNode):
+            if rand.random() < 0.5:
+                output += random_subject(rand, node.node_list)
+        elif isinstance(node, grammar.MacroTagNode):
+            output += ''.join(rand.choice(STRESS_MACROS[node.macro])
+                              for i in range(rand.randint(1, 3)))
+        elif isinstance(node, grammar.SegmentTagNode):
+            count = rand.randint(node.min, node.max or node.min + 1)
+            output += '/'.join(''.join(rand.choice('ab.-')
+                                       for j in range(rand.randint(1, 2)))
+                               for i in range(count))
+        else:
+            output += ''.join(rand.choice(STRESS_SUBJECT)
+                              for i in range(rand.randint(0, 3)))
+    if rand.random() < 0.3 and output:
+        # mutate so that some subjects do not match
+        i = rand.randrange(len(output))
+        output = output[:i] + rand.choice(STRESS_SUBJECT) + output[i + 1:]
+    return output
+
+def reference_run(subject, pos, allowed, min):
+    """
+        greedy end positions of a run of allowed characters; allowed of
+        None means any character
+    """
+    end = pos
+    while end < len(subject) and (allowed is None or subject[end] in allowed):
+        end += 1
+    return range(end, pos + min - 1, -1)
+
+def reference_segments(subject, pos, node, count):
+    if node.max is None or count < node.max:
+        if subject[pos:pos + 1] == '/':
+            for end in reference_run(subject, pos + 1, STRESS_SEGMENT, 1):
+                for result in reference_segments(subject, end, node, count + 1):
+                    yield result
+    if count >= node.min:
+        yield pos
+
+def reference_node(subject, pos, node):
+    if isinstance(node, grammar.TextNode):
+        if subject.startswith(node.token, pos):
+            yield pos + len(node.token)
+    elif isinstance(node, grammar.WildcardNode):
+        for end in reference_run(subject, pos, None, 0):
+            yield end
+    elif isinstance(node, grammar.SegmentWildcardNode):
+        for end in reference_run(subject, pos, STRESS_SEGMENT, 0):
+            yield end
+    elif isinstance(node, grammar.MacroTagNode):
+        for end in reference_run(subject, pos, STRESS_MACROS[node.macro], 1):
+            yield end
+    elif isinstance(node, grammar.SegmentTagNode):
+        for end in reference_run(subject, pos, STRESS_SEGMENT, 1):
+            for result in reference_segments(subject, end, node, 1):
+                yield result
+    elif isinstance(node, grammar.TagNode):
+        for end in reference_run(subject, pos, None, 1):
+            yield end
+
+def reference_match(node_list, subject, pos=0, groups=None):
+    """
+        yield (end, groups) for every way node_list matches at pos, in the
+        order the re module tries them
+    """
+    if groups is None:
+        groups = {}
+    if not node_list:
+        yield pos, groups
+        return
+    node, rest = node_list[0], node_list[1:]
+    if isinstance(node, grammar.OptionalNode):
+        for end, inner in reference_match(node.node_list, subject, pos, groups):
+            for result in reference_match(rest, subject, end, inner):
+                yield result
+        for result in reference_match(rest, subject, pos, groups):
+            yield result
+        return
+    for end in reference_node(subject, pos, node):
+        captured = groups
+        if isinstance(node, grammar.TagNode) and node.name:
+            captured = dict(groups)
+            captured[node.name] = subject[pos:end]
+        for result in reference_match(rest, subject, end, captured):
+            yield result
+
+def reference_groupdict(node_list, subject, names):
+    for end, groups in reference_match(node_list, subject):
+        result = dict((name, None) for name in names)
+        result.update(groups)
+        return result
+
+class TestStress(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(STRESS_SEED)
+
+    def assertWithinBudget(self, func, seconds, memory=None):
+        """
+            call func and fail if it takes longer than seconds or, where
+            tracemalloc is available, allocates more than memory bytes
+        """
+        if memory is not None and tracemalloc is not None:
+            tracemalloc.start()
+        start = default_timer()
+        try:
+            result = func()
+        finally:
+            elapsed = default_timer() - start
+            if memory is not None and tracemalloc is not None:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        self.assertTrue(elapsed <= seconds * STRESS_SCALE,
+                        'took %.3fs, budget %.3fs' % (elapsed, seconds))
+        if memory is not None and tracemalloc is not None:
+            self.assertTrue(peak <= memory,
+                            'peak %d bytes, budget %d' % (peak, memory))
+        return result
+
+    def test_random_round_trip(self):
+        checked = 0
+        for i in range(500):
+            node_list = random_node_list(self.rand, [], text=STRESS_REGEX_TEXT)
+            surlex = render(node_list)
+            self.assertEqual(grammar.Parser(surlex).get_node_list(), node_list,
+                             'parsing %r' % surlex)
+            try:
+                original = re.compile(surl(surlex))
+            except re.error:
+                # raw metacharacters in text can make an invalid regex
+                continue
+            # Surlex.match goes through the canonical regex, which must
+            # behave exactly like the original translation
+            obj = Surlex(surlex)
+            for j in range(5):
+                if j < 3:
+                    subject = random_subject(self.rand, node_list)
+                else:
+                    subject = ''.join(self.rand.choice(STRESS_REGEX_TEXT + '19')
+                                      for k in range(self.rand.randint(0, 12)))
+                expected = original.match(subject)
+                if expected:
+                    expected = expected.groupdict()
+                self.assertEqual(obj.match(subject), expected,
+                                 'matching %r against %r (canonical %r)' %
+                                 (subject, surlex, obj.canonical))
+            checked += 1
+        self.assertTrue(checked > 100)
+
+    def test_random_match(self):
+        for i in range(300):
+            names = []
+            node_list = random_node_list(self.rand, names)
+            surlex = Surlex(render(node_list))
+            for j in range(5):
+                if j < 3:
+                    subject = random_subject(self.rand, node_list)
+                else:
+                    subject = ''.join(self.rand.choice(STRESS_SUBJECT)
+                                      for k in range(self.rand.randint(0, 12)))
+                expected = reference_groupdict(node_list, subject, names)
+                self.assertEqual(surlex.match(subject), expected,
+                                 'matching %r against %r' % (subject, surlex.surlex))
+                self.assertEqual(surlex.matches(subject), expected is not None)
+
+    def test_long_tag(self):
+        surlex = '/<name=' + 'a' * 100000 + '>/'
+        regex = self.assertWithinBudget(lambda: surl(surlex), 1.0, 4 * 1024 * 1024)
+        self.assertEqual(len(regex), 100012)
+
+    def test_long_text(self):
+        surlex = 'a.b/' * 25000
+        self.assertWithinBudget(lambda: surl(surlex), 1.0, 4 * 1024 * 1024)
+
+    def test_many_optionals(self):
+        surlex = '/a(/<:#>)' * 2000
+        regex = self.assertWithinBudget(lambda: surl(surlex), 1.0, 8 * 1024 * 1024)
+        self.assertEqual(regex.count('(/\\d+)?'), 2000)
+        node_list = grammar.Parser(surlex).get_node_list()
+        canonical = self.assertWithinBudget(
+            lambda: grammar.canonicalize(node_list), 1.0)
+        self.assertEqual(len(canonical), 4000)
+
+    def test_deep_nesting(self):
+        depth = 80
+        surlex = '(a' * depth + ')' * depth
+        node_list = self.assertWithinBudget(
+            lambda: grammar.Parser(surlex).get_node_list(), 1.0)
+        self.assertEqual(len(grammar.canonicalize(node_list)), 1)
+        self.assertTrue(Surlex(surlex).matches('a' * depth))
+
+    def test_huge_subject(self):
+        surlex = Surlex('/<section/>/<page/>/<*>$')
+        subject = '/' + 'a' * 1000000 + '/' + 'b' * 1000000 + '/' + 'c' * 1000000
+        m = self.assertWithinBudget(lambda: surlex.match_spans(subject), 1.0, 1024 * 1024)
+        self.assertEqual(m['page'], (1000002, 2000002))
+        failing = subject + '/'
+        self.assertEqual(
+            self.assertWithinBudget(lambda: surlex.match_spans(failing), 1.0), None)
+
+    def test_many_routes(self):
+        surlexes = ['/r%d/<year:Y>/<slug:s>/(<page:#>/)' % i for i in range(2000)]
+        def build():
+            return routetable.RouteTable(routetable.build_route_table(surlexes))
+        table = self.assertWithinBudget(build, 5.0)
+        self.assertEqual(
+            self.assertWithinBudget(lambda: table.match_index('/r1999/2008/x/'), 1.0),
+            1999,
+        )
+
 if __name__ == '__main__':
     unittest.main()